@@ -1,17 +1,66 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, BinaryIO
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from async_lru import alru_cache
+import asyncio
 import httpx
-import io
+import logging
+import msgspec
+import orjson
+import cv2
+import numpy as np
 from PIL import Image
-from pyzbar.pyzbar import decode
+import zxingcpp
 import os
+import secrets
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI(title="EcoScanApp API", version="1.0.0")
+logger = logging.getLogger("ecoscan")
+
+OFF_BASE_URL = "https://world.openfoodfacts.org"
+OFF_PRODUCT_PATH = "/api/v2/product/"
+OFF_SEARCH_PATH = "/cgi/search.pl"
+# Only request the keys the handlers read; full product payloads are often 100+ KB
+OFF_FIELDS = "code,product_name,product_name_en,brands,image_front_url,categories,ingredients_text_en,nutriscore_grade,ecoscore_grade,ecoscore_data,packaging_tags"
+OFF_SEARCH_FIELDS = "code,product_name,brands,ecoscore_grade,image_front_small_url"
+USER_AGENT = os.environ.get("USER_AGENT", "EcoScanApp/1.0 (contact@ecoscan.app)")
+# Token required to force a cache refresh; refreshing is disabled when unset
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Worker processes sharing this host (uvicorn reads the same variable for --workers);
+# each one gets an equal share of the cores for barcode decoding
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+DECODE_THREADS = int(os.environ.get("DECODE_THREADS", "0")) or max(1, (os.cpu_count() or 1) // WORKERS)
+
+# Fail fast on dead upstreams while leaving room to read large product payloads
+HTTP_TIMEOUTS = httpx.Timeout(connect=2.0, read=8.0, write=3.0, pool=1.0)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client for the app lifetime so Open Food Facts connections are reused
+    app.state.off_client = httpx.AsyncClient(
+        base_url=OFF_BASE_URL,
+        headers={"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, br"},
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        timeout=HTTP_TIMEOUTS,
+        http2=True,
+    )
+    # Bounded pool for barcode decoding so CPU work stays off the event loop
+    app.state.decode_pool = ThreadPoolExecutor(max_workers=DECODE_THREADS)
+    try:
+        yield
+    finally:
+        await app.state.off_client.aclose()
+        app.state.decode_pool.shutdown(wait=False)
+
+
+app = FastAPI(title="EcoScanApp API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,18 +70,55 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-OFF_BASE_URL = "https://world.openfoodfacts.org/api/v2/product/"
-USER_AGENT = os.environ.get("USER_AGENT", "EcoScanApp/1.0 (contact@ecoscan.app)")
+# Upstream statuses worth caching; OFF answers unknown products with 404
+OFF_CACHEABLE_STATUSES = frozenset((200, 404))
+
+# Upstream response caching (seconds)
+PRODUCT_CACHE_TTL = 3600
+ALTERNATIVES_CACHE_TTL = 12 * 3600
 
 # Carbon footprint thresholds (kg CO2e per unit)
 CARBON_THRESHOLD = 2.0
 
-class Recommendation(BaseModel):
+# Score grades used by the recommendation rules
+GOOD_GRADES = frozenset({'a', 'b'})
+BAD_GRADES = frozenset({'d', 'e'})
+
+# GTIN-8, UPC-A, EAN-13 and GTIN-14
+_VALID_GTIN_LENS = frozenset((8, 12, 13, 14))
+
+# Upload limits, checked before any image decoding
+ALLOWED_IMAGE_TYPES = frozenset({"image/jpeg", "image/png", "image/webp"})
+MAX_UPLOAD = 8 * 1024 * 1024
+# PIL warns above this and refuses images over twice it, so the hard cap is 80 MP
+Image.MAX_IMAGE_PIXELS = 40_000_000
+
+# Barcode decoding: cap the long edge and only scan for GTIN-bearing symbologies
+DECODE_MAX_SIZE = (1600, 1600)
+GTIN_FORMATS = (
+    zxingcpp.BarcodeFormat.EAN13,
+    zxingcpp.BarcodeFormat.EAN8,
+    zxingcpp.BarcodeFormat.UPCA,
+    zxingcpp.BarcodeFormat.UPCE,
+    zxingcpp.BarcodeFormat.ITF14,
+)
+
+# Enhancement passes tried in order on the grayscale image, cheapest first.
+# Only the last pass lets zxing-cpp also try its own downscaled and inverted scans.
+PREPROCESS_STEPS = [
+    lambda a: a,
+    lambda a: 255 - a,
+    lambda a: cv2.threshold(a, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1],
+    lambda a: cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(a),
+    lambda a: cv2.dilate(a, np.ones((2, 2), np.uint8)),
+]
+
+class Recommendation(msgspec.Struct):
     icon: str
     text: str
     priority: str
 
-class ProductResponse(BaseModel):
+class ProductResponse(msgspec.Struct):
     status: str
     gtin: Optional[str] = None
     name: Optional[str] = None
@@ -51,26 +137,66 @@ class ProductResponse(BaseModel):
     message: Optional[str] = None
 
 
-def extract_gtin_from_image(image_data: bytes) -> Optional[str]:
-    """Extract barcode from image using pyzbar."""
+# Response constructors with the per-status constant fields pre-bound
+_ok_response = partial(ProductResponse, status="success", source="OpenFoodFacts")
+_not_found_response = partial(ProductResponse, status="not_found")
+
+
+def _is_itf14_gtin(code: str) -> bool:
+    """Check an ITF read is 14 digits with a valid GS1 check digit."""
+    if len(code) != 14:
+        return False
+    total = sum(int(d) * (3 if i % 2 == 0 else 1) for i, d in enumerate(code[:-1]))
+    return (10 - total % 10) % 10 == int(code[-1])
+
+
+def extract_gtin_from_image(image_file: BinaryIO) -> Optional[str]:
+    """Extract barcode from an image file using zxing-cpp, retrying with enhanced variants."""
     try:
-        img = Image.open(io.BytesIO(image_data))
-        barcodes = decode(img)
-        if not barcodes:
-            return None
-        gtin = barcodes[0].data.decode('utf-8')
-        if gtin.isdigit() and len(gtin) in [8, 12, 13, 14]:
-            return gtin
+        # Read straight from the upload; let JPEGs decode at reduced scale where possible
+        img = Image.open(image_file)
+        img.draft('L', DECODE_MAX_SIZE)
+        # Grayscale and downscale before decoding; decode cost scales with pixel count
+        img = img.convert('L')
+        img.thumbnail(DECODE_MAX_SIZE, Image.Resampling.BILINEAR)
+        arr = np.asarray(img)
+        
+        # Stop at the first pass that yields a valid GTIN
+        last_step = len(PREPROCESS_STEPS) - 1
+        for i, step in enumerate(PREPROCESS_STEPS):
+            try_harder = i == last_step
+            barcodes = zxingcpp.read_barcodes(
+                np.ascontiguousarray(step(arr)),
+                formats=GTIN_FORMATS,
+                try_rotate=True,
+                try_downscale=try_harder,
+                try_invert=try_harder,
+            )
+            for barcode in barcodes:
+                gtin = barcode.text
+                if not gtin.isdigit() or len(gtin) not in _VALID_GTIN_LENS:
+                    continue
+                # The ITF14 filter still reports plain ITF reads; only a full ITF-14 is a GTIN
+                if barcode.format == zxingcpp.BarcodeFormat.ITF and not _is_itf14_gtin(gtin):
+                    continue
+                return gtin
         return None
-    except Exception as e:
-        print(f"Barcode decode error: {e}")
+    except Exception:
+        logger.exception("barcode decode failed")
         return None
 
 
+# Numeric eco score for grades 'a'..'e', indexed by ord(grade) - ord('a')
+_ECO_TABLE = (95, 80, 65, 45, 20)
+
+
 def get_eco_score_value(eco_score: str) -> int:
     """Convert eco score grade to numeric value."""
-    scores = {'a': 95, 'b': 80, 'c': 65, 'd': 45, 'e': 20}
-    return scores.get(eco_score.lower() if eco_score else '', 50)
+    if eco_score and len(eco_score) == 1:
+        index = ord(eco_score) | 0x20  # ASCII lowercase
+        if 97 <= index <= 101:
+            return _ECO_TABLE[index - 97]
+    return 50
 
 
 def generate_recommendations(product_data: dict, carbon_footprint: float) -> List[Recommendation]:
@@ -88,13 +214,13 @@ def generate_recommendations(product_data: dict, carbon_footprint: float) -> Lis
         ))
     
     # Eco score based recommendations
-    if eco_score in ['d', 'e']:
+    if eco_score in BAD_GRADES:
         recommendations.append(Recommendation(
             icon="🌱",
             text="Low environmental score - look for products with better eco ratings",
             priority="high"
         ))
-    elif eco_score in ['a', 'b']:
+    elif eco_score in GOOD_GRADES:
         recommendations.append(Recommendation(
             icon="✅",
             text="Good environmental score! This product has lower environmental impact",
@@ -102,7 +228,7 @@ def generate_recommendations(product_data: dict, carbon_footprint: float) -> Lis
         ))
     
     # Nutrition recommendations
-    if nutri_score in ['d', 'e']:
+    if nutri_score in BAD_GRADES:
         recommendations.append(Recommendation(
             icon="❤️",
             text=f"Nutrition score is {nutri_score.upper()} - consider healthier options",
@@ -111,7 +237,8 @@ def generate_recommendations(product_data: dict, carbon_footprint: float) -> Lis
     
     # Packaging recommendations
     packaging = product_data.get('packaging_tags', [])
-    if any('plastic' in p.lower() for p in packaging):
+    # OFF tags are already lowercase, so match substrings without re-lowercasing
+    if any('plastic' in p for p in packaging):
         recommendations.append(Recommendation(
             icon="♻️",
             text="Contains plastic packaging - recycle properly or choose alternatives with less plastic",
@@ -128,6 +255,62 @@ def generate_recommendations(product_data: dict, carbon_footprint: float) -> Lis
     return recommendations
 
 
+def _check_off_response(response: httpx.Response) -> None:
+    """Raise on upstream failures so they are not cached."""
+    if response.status_code not in OFF_CACHEABLE_STATUSES:
+        raise httpx.HTTPStatusError(
+            f"Open Food Facts returned {response.status_code}",
+            request=response.request,
+            response=response
+        )
+
+
+@alru_cache(maxsize=4096, ttl=PRODUCT_CACHE_TTL)
+async def _fetch_off_product(gtin: str) -> dict:
+    """Fetch raw product JSON from Open Food Facts, cached per GTIN."""
+    response = await app.state.off_client.get(
+        f"{OFF_PRODUCT_PATH}{gtin}",
+        params={"fields": OFF_FIELDS}
+    )
+    _check_off_response(response)
+    return orjson.loads(response.content)
+
+
+@alru_cache(maxsize=1024, ttl=ALTERNATIVES_CACHE_TTL)
+async def _search_alternatives(category_tag: str, current_eco_score: str) -> List[dict]:
+    """Search a category for products scoring better than the current one, cached per (category, grade)."""
+    params = {
+        "action": "process",
+        "tagtype_0": "categories",
+        "tag_contains_0": "contains",
+        "tag_0": category_tag,
+        "sort_by": "ecoscore_score",
+        "page_size": 5,
+        "fields": OFF_SEARCH_FIELDS,
+        "json": 1
+    }
+    
+    response = await app.state.off_client.get(OFF_SEARCH_PATH, params=params)
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    
+    alternatives = []
+    current_score = get_eco_score_value(current_eco_score)
+    
+    for product in data.get('products', [])[:5]:
+        alt_eco = product.get('ecoscore_grade', '')
+        if get_eco_score_value(alt_eco) > current_score:
+            alternatives.append({
+                "name": product.get('product_name', 'Unknown'),
+                "brand": product.get('brands', 'Unknown'),
+                "eco_score": alt_eco,
+                "image_url": product.get('image_front_small_url'),
+                "gtin": product.get('code')
+            })
+    
+    return alternatives[:3]
+
+
 async def fetch_alternatives(category: str, current_eco_score: str) -> List[dict]:
     """Fetch alternative products with better eco scores from the same category."""
     if not category:
@@ -135,43 +318,9 @@ async def fetch_alternatives(category: str, current_eco_score: str) -> List[dict
     
     try:
         # Search for better alternatives in the same category
-        search_url = f"https://world.openfoodfacts.org/cgi/search.pl"
-        params = {
-            "action": "process",
-            "tagtype_0": "categories",
-            "tag_contains_0": "contains",
-            "tag_0": category.split(',')[0].strip(),
-            "sort_by": "ecoscore_score",
-            "page_size": 5,
-            "json": 1
-        }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                search_url,
-                params=params,
-                headers={"User-Agent": USER_AGENT},
-                timeout=10.0
-            )
-            data = response.json()
-        
-        alternatives = []
-        current_score = get_eco_score_value(current_eco_score)
-        
-        for product in data.get('products', [])[:5]:
-            alt_eco = product.get('ecoscore_grade', '')
-            if get_eco_score_value(alt_eco) > current_score:
-                alternatives.append({
-                    "name": product.get('product_name', 'Unknown'),
-                    "brand": product.get('brands', 'Unknown'),
-                    "eco_score": alt_eco,
-                    "image_url": product.get('image_front_small_url'),
-                    "gtin": product.get('code')
-                })
-        
-        return alternatives[:3]
+        return await _search_alternatives(category.split(',')[0].strip(), current_eco_score or '')
     except Exception as e:
-        print(f"Error fetching alternatives: {e}")
+        logger.warning("alternatives fetch failed: %s", e)
         return []
 
 
@@ -185,38 +334,39 @@ async def health():
     return {"status": "healthy"}
 
 
-@app.post("/api/scan", response_model=ProductResponse)
-async def scan_product(image: UploadFile = File(...)):
-    """Scan a product barcode image and return sustainability data."""
-    
-    # Read and validate image
-    image_data = await image.read()
-    if not image_data:
-        raise HTTPException(status_code=400, detail="Empty image file")
-    
-    # Extract barcode
-    gtin = extract_gtin_from_image(image_data)
-    if not gtin:
-        return ProductResponse(
-            status="not_found",
-            message="No barcode detected. Please ensure the barcode is clearly visible."
-        )
+# msgspec structs are invisible to FastAPI, so describe the response in OpenAPI by hand
+(_PRODUCT_SCHEMA,), _PRODUCT_COMPONENTS = msgspec.json.schema_components(
+    [ProductResponse], ref_template="#/components/schemas/{name}"
+)
+PRODUCT_RESPONSES = {200: {"content": {"application/json": {"schema": _PRODUCT_SCHEMA}}}}
+_default_openapi = app.openapi
+
+
+def _openapi() -> dict:
+    schema = _default_openapi()
+    schema.setdefault("components", {}).setdefault("schemas", {}).update(_PRODUCT_COMPONENTS)
+    return schema
+
+
+app.openapi = _openapi
+
+
+def _json_response(payload: ProductResponse) -> Response:
+    """Encode an output struct straight to JSON bytes, bypassing FastAPI's serializer."""
+    return Response(content=msgspec.json.encode(payload), media_type="application/json")
+
+
+async def _build_product_response(gtin: str) -> ProductResponse:
+    """Look up a GTIN on Open Food Facts and assemble the sustainability response."""
     
     # Fetch product data from Open Food Facts
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{OFF_BASE_URL}{gtin}",
-                headers={"User-Agent": USER_AGENT},
-                timeout=10.0
-            )
-            data = response.json()
+        data = await _fetch_off_product(gtin)
     except Exception as e:
         raise HTTPException(status_code=500, detail="Failed to fetch product data")
     
     if not data.get('product') or data.get('status') == 0:
-        return ProductResponse(
-            status="not_found",
+        return _not_found_response(
             gtin=gtin,
             message=f"Product with barcode {gtin} not found in database."
         )
@@ -225,28 +375,27 @@ async def scan_product(image: UploadFile = File(...)):
     
     # Extract carbon footprint
     carbon_footprint = None
-    carbon_unit = None
     ecoscore_data = product.get('ecoscore_data', {})
     if ecoscore_data:
         agribalyse = ecoscore_data.get('agribalyse', {})
         carbon_footprint = agribalyse.get('co2_total')
-        carbon_unit = "kg CO2e/kg"
     
     is_high_carbon = carbon_footprint is not None and carbon_footprint > CARBON_THRESHOLD
     
-    # Generate recommendations
-    recommendations = generate_recommendations(product, carbon_footprint or 0)
-    
-    # Fetch alternatives if high carbon
-    alternatives = []
+    # Start fetching alternatives if high carbon, overlapping with local processing
+    alternatives_task = None
     if is_high_carbon:
-        alternatives = await fetch_alternatives(
+        alternatives_task = asyncio.create_task(fetch_alternatives(
             product.get('categories'),
             product.get('ecoscore_grade', '')
-        )
+        ))
     
-    return ProductResponse(
-        status="success",
+    # Generate recommendations
+    recommendations = generate_recommendations(product, carbon_footprint or 0)
+    
+    alternatives = await alternatives_task if alternatives_task else []
+    
+    return _ok_response(
         gtin=gtin,
         name=product.get('product_name') or product.get('product_name_en', 'Unknown Product'),
         brand=product.get('brands', 'Unknown Brand'),
@@ -256,76 +405,70 @@ async def scan_product(image: UploadFile = File(...)):
         nutri_score=product.get('nutriscore_grade'),
         eco_score=product.get('ecoscore_grade'),
         carbon_footprint=carbon_footprint,
-        carbon_footprint_unit=carbon_unit,
+        carbon_footprint_unit="kg CO2e/kg" if carbon_footprint is not None else None,
         is_high_carbon=is_high_carbon,
         recommendations=recommendations,
-        alternatives=alternatives,
-        source="OpenFoodFacts"
+        alternatives=alternatives
     )
 
 
-@app.get("/api/product/{gtin}", response_model=ProductResponse)
-async def get_product(gtin: str):
-    """Get product data by GTIN/barcode number."""
-    
-    if not gtin.isdigit() or len(gtin) not in [8, 12, 13, 14]:
-        raise HTTPException(status_code=400, detail="Invalid barcode format")
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{OFF_BASE_URL}{gtin}",
-                headers={"User-Agent": USER_AGENT},
-                timeout=10.0
-            )
-            data = response.json()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Failed to fetch product data")
+@app.post("/api/scan", response_model=None, responses=PRODUCT_RESPONSES)
+async def scan_product(image: UploadFile = File(...)):
+    """Scan a product barcode image and return sustainability data."""
     
-    if not data.get('product') or data.get('status') == 0:
-        return ProductResponse(
-            status="not_found",
-            gtin=gtin,
-            message=f"Product with barcode {gtin} not found."
-        )
+    # Validate image without buffering the upload into memory
+    if image.content_type not in ALLOWED_IMAGE_TYPES:
+        raise HTTPException(status_code=415, detail="Unsupported image type")
+    if not image.size:
+        raise HTTPException(status_code=400, detail="Empty image file")
+    if image.size > MAX_UPLOAD:
+        raise HTTPException(status_code=413, detail="Image file too large")
     
-    product = data['product']
+    # Extract barcode
+    gtin = await asyncio.get_running_loop().run_in_executor(
+        app.state.decode_pool, extract_gtin_from_image, image.file
+    )
+    if not gtin:
+        return _json_response(_not_found_response(
+            message="No barcode detected. Please ensure the barcode is clearly visible."
+        ))
     
-    carbon_footprint = None
-    ecoscore_data = product.get('ecoscore_data', {})
-    if ecoscore_data:
-        agribalyse = ecoscore_data.get('agribalyse', {})
-        carbon_footprint = agribalyse.get('co2_total')
+    return _json_response(await _build_product_response(gtin))
+
+
+@app.get("/api/product/{gtin}", response_model=None, responses=PRODUCT_RESPONSES)
+async def get_product(
+    gtin: str,
+    refresh: bool = False,
+    x_admin_token: Optional[str] = Header(default=None)
+):
+    """Get product data by GTIN/barcode number. Admins can pass refresh=true to bypass the cache."""
     
-    is_high_carbon = carbon_footprint is not None and carbon_footprint > CARBON_THRESHOLD
-    recommendations = generate_recommendations(product, carbon_footprint or 0)
+    if not gtin.isdigit() or len(gtin) not in _VALID_GTIN_LENS:
+        raise HTTPException(status_code=400, detail="Invalid barcode format")
     
-    alternatives = []
-    if is_high_carbon:
-        alternatives = await fetch_alternatives(
-            product.get('categories'),
-            product.get('ecoscore_grade', '')
-        )
+    if refresh:
+        if not ADMIN_TOKEN or not secrets.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+            raise HTTPException(status_code=403, detail="Cache refresh requires a valid admin token")
+        _fetch_off_product.cache_invalidate(gtin)
     
-    return ProductResponse(
-        status="success",
-        gtin=gtin,
-        name=product.get('product_name') or product.get('product_name_en', 'Unknown Product'),
-        brand=product.get('brands', 'Unknown Brand'),
-        image_url=product.get('image_front_url'),
-        category=product.get('categories'),
-        ingredients_text=product.get('ingredients_text_en'),
-        nutri_score=product.get('nutriscore_grade'),
-        eco_score=product.get('ecoscore_grade'),
-        carbon_footprint=carbon_footprint,
-        carbon_footprint_unit="kg CO2e/kg" if carbon_footprint else None,
-        is_high_carbon=is_high_carbon,
-        recommendations=recommendations,
-        alternatives=alternatives,
-        source="OpenFoodFacts"
-    )
+    return _json_response(await _build_product_response(gtin))
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Export the worker count so each worker process sizes its decode pool to match
+    workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    # "auto" picks uvloop and httptools when installed (uvloop is unavailable on Windows)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="auto",
+        http="auto",
+        limit_concurrency=1000,
+        backlog=2048,
+        log_level="warning",
+    )
\ No newline at end of file
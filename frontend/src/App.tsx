@@ -38,6 +38,10 @@ interface Product {
 
 const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
 
+// Must match the upload limits enforced by the backend
+const ACCEPTED_IMAGE_TYPES = ['image/jpeg', 'image/png', 'image/webp']
+const MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+
 export default function App() {
   const [product, setProduct] = useState<Product | null>(null)
   const [isLoading, setIsLoading] = useState(false)
@@ -64,10 +68,20 @@ export default function App() {
   const scoreColorStyle = getEcoScoreColor(product?.eco_score)
 
   const scanProduct = async (file: File) => {
-    setIsLoading(true)
     setError(null)
     setProduct(null)
 
+    if (!ACCEPTED_IMAGE_TYPES.includes(file.type)) {
+      setError('Unsupported image type. Please use a JPEG, PNG or WebP image.')
+      return
+    }
+    if (file.size > MAX_UPLOAD_BYTES) {
+      setError('Image file too large. Please use an image under 8 MB.')
+      return
+    }
+
+    setIsLoading(true)
+
     const formData = new FormData()
     formData.append('image', file)
 
@@ -77,6 +91,12 @@ export default function App() {
         body: formData,
       })
 
+      if (response.status === 413 || response.status === 415) {
+        const body = await response.json().catch(() => null)
+        setError(body?.detail || 'This image cannot be scanned.')
+        return
+      }
+
       if (!response.ok) {
         throw new Error('Failed to scan product')
       }
@@ -104,7 +124,7 @@ export default function App() {
     e.preventDefault()
     setIsDragging(false)
     const file = e.dataTransfer.files[0]
-    if (file && file.type.startsWith('image/')) {
+    if (file && ACCEPTED_IMAGE_TYPES.includes(file.type)) {
       scanProduct(file)
     }
   }, [])
@@ -251,7 +271,7 @@ export default function App() {
                 <input
                   ref={fileInputRef}
                   type="file"
-                  accept="image/*"
+                  accept={ACCEPTED_IMAGE_TYPES.join(',')}
                   onChange={handleFileChange}
                   className="hidden"
                   title="Upload barcode image"